@@ -0,0 +1,36 @@
+import random
+
+
+def drawn_by_rule(board):
+    """Whether the position is drawn by the rules, whatever the side to move plays."""
+    return (
+        board.is_repetition(3)
+        or board.is_fifty_moves()
+        or board.is_insufficient_material()
+        or board.is_stalemate()
+    )
+
+
+def drawish_order_key(board, move):
+    """Cheap guess at how drawish a move is; higher keys should be tried first.
+
+    The first element is whether the move draws by the rules outright.
+    """
+    quiet = not board.is_zeroing(move)
+    calm = not board.gives_check(move)
+    board.push(move)
+    try:
+        return drawn_by_rule(board), board.is_repetition(2), quiet, calm, random.random()
+    finally:
+        board.pop()
+
+
+def child_board(board, move, stack=True):
+    """Return a copy of the board with the move played.
+
+    Keep the move stack for anything sent to Stockfish, which needs the game history to
+    score repetitions as draws.
+    """
+    child = board.copy(stack=stack)
+    child.push(move)
+    return child
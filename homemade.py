@@ -1,8 +1,16 @@
 from __future__ import annotations
 import chess
+import chess.polyglot
 from chess.engine import PlayResult, Limit
+import os
+import queue
 import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from lib.engine_wrapper import MinimalEngine, MOVE
+from drawishness import drawish_order_key, child_board
 from typing import Any
 import logging
 
@@ -12,6 +20,16 @@ import logging
 # logger.debug("message") will only print "message" if verbose logging is enabled.
 logger = logging.getLogger(__name__)
 
+# Maximum number of evaluations kept in an engine's transposition table
+TRANSPOSITION_TABLE_SIZE = 100_000
+# Most Stockfish processes a single game may start; lichess-bot runs one engine per game
+STOCKFISH_POOL_SIZE = 4
+# Total hash table size in MB for a game's Stockfish processes: half for the root search engine,
+# half shared by the pool, so tables persist usefully between moves without growing with the pool
+STOCKFISH_HASH = 256
+# How many of the likeliest drawish moves are analysed on their own before the MultiPV search
+PROBED_MOVES = 3
+
 
 class ExampleEngine(MinimalEngine):
     """An example engine that all homemade engines inherit."""
@@ -31,20 +49,126 @@ class ILoveDraws(ExampleEngine):
         **popen_args: str,
     ):
         super().__init__(commands, options, stderr, draw_or_resign, game, **popen_args)
+        # One thread per core, up to STOCKFISH_POOL_SIZE
+        self.threads = min(os.cpu_count() or 1, STOCKFISH_POOL_SIZE)
+        # Does all the analysis unless Stockfish leaves moves unscored, multi-threaded
         self.stockfish = chess.engine.SimpleEngine.popen_uci("./TEMP/sf")
+        try:
+            self.stockfish.configure({"Threads": self.threads, "Hash": STOCKFISH_HASH // 2})
+        except Exception:
+            self.stockfish.quit()
+            raise
+        # Single-threaded Stockfish processes for analysing unscored moves concurrently,
+        # only started the first time they are needed
+        self.pool = []
+        self.idle = queue.Queue()
+        self.executor = None
+        # Background analysis of the opponent's position, running until our next search
+        self.pondering = None
         self.minimal_drawishness = 10  # centipawns
+        # Evaluations keyed by (zobrist hash, repetition, search time), kept across searches
+        self.tt = OrderedDict()
+        self.tt_lock = threading.Lock()
+
+    def start_pool(self):
+        if self.pool:
+            return
+        poolHash = max(16, STOCKFISH_HASH // 2 // self.threads)
+        try:
+            for _ in range(self.threads):
+                stockfish = chess.engine.SimpleEngine.popen_uci("./TEMP/sf")
+                self.pool.append(stockfish)
+                stockfish.configure({"Threads": 1, "Hash": poolHash})
+        except Exception:
+            # Don't leak the processes that did start
+            for stockfish in self.pool:
+                stockfish.quit()
+            self.pool = []
+            raise
+        for stockfish in self.pool:
+            self.idle.put(stockfish)
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+
+    def evaluate(self, board, limit, pooled=False):
+        # The same position scores differently once it has already occurred in the game
+        key = (
+            chess.polyglot.zobrist_hash(board),
+            board.is_repetition(2),
+            round(limit.time, 3),
+        )
+        with self.tt_lock:
+            if key in self.tt:
+                self.tt.move_to_end(key)
+                return self.tt[key]
+
+        if pooled:
+            # Borrow an idle Stockfish from the pool for the duration of the analysis
+            stockfish = self.idle.get()
+            try:
+                result = stockfish.analyse(board, limit)
+            finally:
+                self.idle.put(stockfish)
+        else:
+            result = self.stockfish.analyse(board, limit)
+        evaluation = result["score"].relative
+
+        with self.tt_lock:
+            self.tt[key] = evaluation
+            if len(self.tt) > TRANSPOSITION_TABLE_SIZE:
+                self.tt.popitem(last=False)
+        return evaluation
+
+    def evaluate_root(self, board, moves, timeLimit):
+        """Score the given root moves from the opponent's perspective with one MultiPV search.
 
-    def evaluate(self, board, timeLimit=0.1):
-        result = self.stockfish.analyse(
-            board, chess.engine.Limit(time=timeLimit - 0.01)
+        Returns None if Stockfish does not support MultiPV.
+        """
+        if "MultiPV" not in self.stockfish.options:
+            return None
+        infos = self.stockfish.analyse(
+            board,
+            Limit(time=max(0.001, timeLimit - 0.01)),
+            multipv=len(moves),
+            root_moves=moves,
         )
-        return result["score"].relative
 
-    def search(self, board: chess.Board, time_left, *args) -> chess.engine.PlayResult:
+        return {
+            info["pv"][0]: info["score"].pov(not board.turn)
+            for info in infos
+            if info.get("pv") and "score" in info
+        }
+
+    def ponder(self, board):
+        """Start the root search engine analysing the opponent's position in the background.
+
+        The analysis runs for as long as the opponent thinks, warming the hash table for the
+        next search, which stops it.
+        """
+        try:
+            self.pondering = self.stockfish.analysis(board)
+        except chess.engine.EngineError:
+            logger.exception("Could not start pondering")
+
+    def stop_pondering(self):
+        if self.pondering is None:
+            return
+        try:
+            self.pondering.stop()
+            self.pondering.wait()
+        except chess.engine.EngineError:
+            logger.exception("Pondering failed")
+        self.pondering = None
+
+    def search(self, board: chess.Board, time_left, ponder=False, *args) -> chess.engine.PlayResult:
+        self.stop_pondering()
+
         # Get amount of legal moves
         legalMoves = list(board.legal_moves)
-        # Shuffle the moves to make the bot less predictable
-        random.shuffle(legalMoves)
+        moveCount = len(legalMoves)
+        # Try the likeliest drawish moves first so the cutoff below fires sooner,
+        # breaking ties randomly to make the bot less predictable
+        orderKeys = {move: drawish_order_key(board, move) for move in legalMoves}
+        legalMoves.sort(key=orderKeys.__getitem__, reverse=True)
 
         # Base search time per move in seconds
         searchTime = 0.1
@@ -52,46 +176,97 @@ class ILoveDraws(ExampleEngine):
         # If the engine will search for more than 10% of the remaining time, then shorten it
         # to be 10% of the remaining time
         # Also, dont do this on the first move (because of weird behaviour with timeLeft being a Limit on first move)
-        if type(time_left) != chess.engine.Limit:
+        if not isinstance(time_left, Limit):
             time_left /= 1000  # Convert to seconds
-            if len(legalMoves) * searchTime > time_left / 10:
-                searchTime = (time_left / 10) / len(legalMoves)
+            if moveCount * searchTime > time_left / 10:
+                searchTime = (time_left / 10) / moveCount
+
+        # A move that draws by the rules is as drawish as it gets, no need to ask Stockfish
+        if orderKeys[legalMoves[0]][0]:
+            move = legalMoves[0]
+        else:
+            move = self.choose_move(board, legalMoves, moveCount, searchTime)
 
+        # While the opponent thinks, let Stockfish search the position we leave them, so
+        # next move's analyses start from a warm hash table
+        if ponder:
+            self.ponder(child_board(board, move, stack=False))
+
+        return PlayResult(move, None)
+
+    def evaluations(self, board, legalMoves, moveCount, searchTime):
+        """Yield each of legalMoves, in order, with its evaluation from the opponent's perspective."""
+        # Shared by every per-move analysis, leaving a little slack for engine overhead
+        limit = Limit(time=max(0.001, searchTime - 0.01))
+
+        # Analyse the likeliest drawish moves on their own first, so the usual case
+        # returns before paying for a MultiPV search over every move
+        probed = legalMoves[:PROBED_MOVES]
+        for move in probed:
+            yield move, self.evaluate(child_board(board, move), limit)
+
+        remaining = legalMoves[len(probed):]
+        if not remaining:
+            return
+
+        # Score the rest with a single MultiPV search, in what is left of the budget
+        rootEvaluations = self.evaluate_root(
+            board, remaining, searchTime * (moveCount - len(probed))
+        ) or {}
+
+        # Analyse any move the root search did not score on its own copy of the board,
+        # spread across the Stockfish pool
+        unscored = [move for move in remaining if move not in rootEvaluations]
+        if unscored:
+            self.start_pool()
+        pending = {
+            move: self.executor.submit(self.evaluate, child_board(board, move), limit, True)
+            for move in unscored
+        }
+
+        try:
+            for move in remaining:
+                if move in rootEvaluations:
+                    yield move, rootEvaluations[move]
+                else:
+                    yield move, pending[move].result()
+        finally:
+            # Stop analyses that have not started yet, so they don't hold up the pool
+            for future in pending.values():
+                future.cancel()
+
+    def choose_move(self, board, legalMoves, moveCount, searchTime):
+        """Return the most drawish of legalMoves, trying them in order."""
         # Initialise variables
         mostDrawishEvaluation = None
         mostDrawishMoves = []
         allEvaluations = []
 
-        # Evaluate each move
-        for move in legalMoves:
-            # Play move
-            board.push(move)
-
-            # Evaluate position from opponent's perspective
-            evaluation = self.evaluate(board, searchTime)
-            evaluation_score = abs(evaluation.score(mate_score=10000))
-            print("evaluation_score", evaluation_score)
-            assert evaluation_score is not None
-            allEvaluations.push(evaluation_score)
-
-            # If the evaluation is less than the minimal_drawishness, return the move
-            if evaluation_score <= self.minimal_drawishness:
-                return PlayResult(move, None)
-
-            # If the evaluation is more drawish than mostDrawishEvaluation, replace the mostDrawishMoves list with just this move
-            if (
-                mostDrawishEvaluation is None
-                or mostDrawishEvaluation < evaluation_score
-            ):
-                mostDrawishEvaluation = evaluation_score
-                mostDrawishMoves = [move]
-
-            # If the evaluation is the same as mostDrawishEvaluation, add the move to the list
-            elif mostDrawishEvaluation == evaluation_score:
-                mostDrawishMoves.append(move)
-
-            # Un-play the move, ready for the next loop
-            board.pop()
+        evaluations = self.evaluations(board, legalMoves, moveCount, searchTime)
+        with closing(evaluations):
+            for move, evaluation in evaluations:
+                # Compare plain centipawn integers rather than Score objects
+                evaluation_score = abs(evaluation.score(mate_score=10000))
+                print("evaluation_score", evaluation_score)
+                allEvaluations.append(evaluation_score)
+
+                # If the evaluation is less than the minimal_drawishness, return the move
+                # without looking at the remaining ones
+                if evaluation_score <= self.minimal_drawishness:
+                    return move
+
+                # If the evaluation is more drawish than mostDrawishEvaluation,
+                # replace the mostDrawishMoves list with just this move
+                if (
+                    mostDrawishEvaluation is None
+                    or evaluation_score < mostDrawishEvaluation
+                ):
+                    mostDrawishEvaluation = evaluation_score
+                    mostDrawishMoves = [move]
+
+                # If the evaluation is the same as mostDrawishEvaluation, add the move to the list
+                elif mostDrawishEvaluation == evaluation_score:
+                    mostDrawishMoves.append(move)
 
         print("mostDrawishMoves", mostDrawishMoves)
         print("mostDrawishEvaluation", mostDrawishEvaluation)
@@ -101,4 +276,13 @@ class ILoveDraws(ExampleEngine):
         else:
             move = random.choice(legalMoves)
 
-        return PlayResult(move, None)
+        return move
+
+    def quit(self):
+        self.stop_pondering()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        for stockfish in self.pool:
+            stockfish.quit()
+        self.stockfish.quit()
+        super().quit()
@@ -0,0 +1,56 @@
+import chess
+
+import drawishness
+
+
+def draws_by_rule(board, san):
+    return drawishness.drawish_order_key(board, board.parse_san(san))[0]
+
+
+def test_drawish_order_key_draws_by_rule_threefold_repetition():
+    board = chess.Board()
+    for san in ["Nf3", "Nf6", "Ng1", "Ng8", "Nf3", "Nf6", "Ng1"]:
+        board.push_san(san)
+    assert draws_by_rule(board, "Ng8")
+    assert not draws_by_rule(board, "e5")
+    assert len(board.move_stack) == 7
+
+
+def test_drawish_order_key_draws_by_rule_stalemate():
+    board = chess.Board("7k/8/6K1/8/8/8/8/5Q2 w - - 0 1")
+    assert draws_by_rule(board, "Qf7")
+    assert not draws_by_rule(board, "Qf8#")
+
+
+def test_drawish_order_key_draws_by_rule_insufficient_material():
+    board = chess.Board("4k3/8/8/8/8/8/3r4/4K3 w - - 0 1")
+    assert draws_by_rule(board, "Kxd2")
+    assert not draws_by_rule(board, "Kf1")
+
+
+def test_drawish_order_key_draws_by_rule_fifty_moves():
+    board = chess.Board("4k3/8/8/8/8/8/8/R3K3 w - - 99 80")
+    assert draws_by_rule(board, "Ra2")
+    # Only claimable by the opponent, who can still avoid it
+    board = chess.Board("4k3/8/8/8/8/8/8/R3K3 w - - 98 80")
+    assert not draws_by_rule(board, "Ra2")
+
+
+def test_drawish_order_key_prefers_quiet_moves():
+    board = chess.Board("4k3/8/8/8/8/8/3r4/R3K3 w - - 0 1")
+    quiet = drawishness.drawish_order_key(board, board.parse_san("Rb1"))
+    capture = drawishness.drawish_order_key(board, board.parse_san("Kxd2"))
+    check = drawishness.drawish_order_key(board, board.parse_san("Ra8+"))
+    assert quiet > check > capture
+    assert board.fen() == "4k3/8/8/8/8/8/3r4/R3K3 w - - 0 1"
+
+
+def test_child_board_leaves_board_untouched():
+    board = chess.Board()
+    board.push_san("e4")
+    move = board.parse_san("e5")
+    child = drawishness.child_board(board, move)
+    assert child.piece_at(chess.E5) == chess.Piece(chess.PAWN, chess.BLACK)
+    assert board.move_stack == [chess.Move.from_uci("e2e4")]
+    assert child.move_stack == [chess.Move.from_uci("e2e4"), move]
+    assert drawishness.child_board(board, move, stack=False).move_stack == [move]